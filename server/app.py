@@ -1,15 +1,18 @@
-import os, asyncio, json, time, secrets
+import os, asyncio, time, secrets, hashlib, hmac, gzip, math
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional, Annotated
 
 from aiohttp import web
 import aiosqlite
+import orjson
 from dotenv import load_dotenv
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field, StringConstraints, ValidationError, field_validator
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
-from aiogram.types import Message, WebAppInfo, MenuButtonWebApp
+from aiogram.types import Message, WebAppInfo, MenuButtonWebApp, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.client.default import DefaultBotProperties
 
 # -------------------- ENV --------------------
@@ -20,13 +23,19 @@ ADMIN_ID         = os.getenv("ADMIN_ID", "").strip()
 ADMIN_BOT_TOKEN  = os.getenv("ADMIN_BOT_TOKEN", "").strip()
 ADMIN_CHAT_ID    = os.getenv("ADMIN_CHAT_ID", "").strip()
 ADMIN_SECRET     = os.getenv("ADMIN_SECRET", "").strip()
+PUBLIC_BASE_URL  = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")
 PORT             = int(os.getenv("PORT", "8000"))
 
 BASE_DIR = Path(__file__).resolve().parent
 WEB_DIR  = BASE_DIR / "web"
 
 DB_PATH    = os.getenv("DB_PATH", "/tmp/shop.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/var/data/uploads")
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(20 * 1024 * 1024)))
+# крупный кусок — меньше переходов в пул потоков и системных write на мегабайт
+UPLOAD_CHUNK = 256 * 1024
+UPLOAD_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp"})
 
 # uploads dir (Render: persistent disk is /var/data)
 try:
@@ -40,8 +49,6 @@ print("UPLOAD_DIR     =", UPLOAD_DIR)
 
 # -------------------- DB --------------------
 CREATE_SQL = """
-PRAGMA journal_mode=WAL;
-
 CREATE TABLE IF NOT EXISTS products (
   sku TEXT PRIMARY KEY,
   title TEXT NOT NULL,
@@ -78,49 +85,166 @@ CREATE TABLE IF NOT EXISTS order_items (
   qty INTEGER NOT NULL,
   FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE
 );
+
+-- витрина: WHERE is_active=1 ORDER BY rowid DESC — индекс отдаёт строки уже в нужном порядке
+CREATE INDEX IF NOT EXISTS idx_products_active ON products(is_active);
+-- витрина с фильтром категории: равенство по обоим полям, внутри ключа строки идут по rowid.
+-- Категории — slug'и в нижнем регистре из админки, поэтому сравнение точное, без NOCASE
+CREATE INDEX IF NOT EXISTS idx_products_active_cat ON products(is_active, category);
+-- позиции заказа выбираются по order_id
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
 """
 
+DB_PRAGMAS = (
+    # действует только на новой базе (до первой записи), на существующей — no-op
+    "page_size=8192",
+    "journal_mode=WAL",
+    "busy_timeout=5000",
+    "synchronous=NORMAL",
+    "cache_size=-20000",
+    "temp_store=memory",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+)
+
+async def _tune(conn: aiosqlite.Connection):
+    # PRAGMA действуют на соединение, поэтому применяем к каждому
+    for p in DB_PRAGMAS:
+        await conn.execute(f"PRAGMA {p}")
+
+async def _connect(readonly: bool = False) -> aiosqlite.Connection:
+    # autocommit: sqlite3 не открывает транзакции сам, границы задаёт write_tx()
+    conn = await aiosqlite.connect(DB_PATH, isolation_level=None)
+    conn.row_factory = aiosqlite.Row
+    await _tune(conn)
+    if readonly:
+        # читатель физически не может писать — случайная запись мимо лока упадёт сразу
+        await conn.execute("PRAGMA query_only=1")
+    return conn
+
+# Долгоживущие соединения: один писатель (под локом) + пул читателей
+_db_rw: Optional[aiosqlite.Connection] = None
+_db_rw_lock = asyncio.Lock()
+_db_ro: "asyncio.Queue[aiosqlite.Connection]" = asyncio.Queue()
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as d:
-        await d.executescript(CREATE_SQL)
+    global _db_rw
+    _db_rw = await _connect()
+    # вся схема — одной транзакцией, а не коммитом на каждый оператор
+    await _db_rw.executescript(f"BEGIN;\n{CREATE_SQL}\nCOMMIT;")
+    # статистика для планировщика, чтобы он выбирал индексы
+    await _db_rw.execute("ANALYZE")
+    for _ in range(max(1, DB_READERS)):
+        _db_ro.put_nowait(await _connect(readonly=True))
+    await load_products()
+
+async def close_db(app=None):
+    global _db_rw
+    while not _db_ro.empty():
+        await _db_ro.get_nowait().close()
+    if _db_rw is not None:
+        # сливаем WAL в основной файл, чтобы на диске осталась одна чистая база
+        await _db_rw.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        await _db_rw.close()
+        _db_rw = None
+
+@asynccontextmanager
+async def get_reader():
+    d = await _db_ro.get()
+    try:
+        yield d
+    finally:
+        _db_ro.put_nowait(d)
+
+@asynccontextmanager
+async def get_writer():
+    async with _db_rw_lock:
+        try:
+            yield _db_rw
+        except BaseException:
+            # и при отмене задачи: иначе лок отпустим с открытой транзакцией
+            await _db_rw.rollback()
+            raise
+
+@asynccontextmanager
+async def write_tx():
+    # вся запись — одна явная транзакция; write-lock берём сразу,
+    # без апгрейда SHARED -> RESERVED, на котором ловится SQLITE_BUSY
+    async with get_writer() as d:
+        await d.execute("BEGIN IMMEDIATE")
+        yield d
         await d.commit()
 
-async def fetch_products(active_only: bool = True) -> List[Dict[str, Any]]:
-    q = "SELECT sku,title,price,currency,image_url,description,is_active,category,stock_status FROM products"
-    if active_only:
-        q += " WHERE is_active=1"
-    q += " ORDER BY rowid DESC"
-    async with aiosqlite.connect(DB_PATH) as d:
-        cur = await d.execute(q)
+# Один неизменный текст запроса на комбинацию фильтров — SQLite переиспользует план.
+# Без "?1 IS NULL OR ..." — иначе планировщик не может взять индекс по категории
+_SQL_PRODUCTS = "SELECT sku,title,price,currency,image_url,description,is_active,category,stock_status FROM products "
+SQL_PRODUCTS: Dict[Tuple[bool, bool], str] = {
+    # (active_only, есть категория); фильтр по категории нужен только витрине
+    (False, False): _SQL_PRODUCTS + "ORDER BY rowid DESC",
+    (True, False):  _SQL_PRODUCTS + "WHERE is_active=1 ORDER BY rowid DESC",
+    (True, True):   _SQL_PRODUCTS + "WHERE is_active=1 AND category = ? ORDER BY rowid DESC",
+}
+
+async def fetch_products(active_only: bool = True, category: Optional[str] = None) -> List[Dict[str, Any]]:
+    q = SQL_PRODUCTS[(active_only, bool(category))]
+    async with get_reader() as d:
+        # категория хранится как прислала админка (slug в нижнем регистре), сравнение точное;
+        # параметр сводим к нижнему регистру в Python — lower() в SQLite знает только ASCII
+        cur = await d.execute(q, (category.lower(),) if category else ())
         rows = await cur.fetchall()
-    cols = ["sku","title","price","currency","image_url","description","is_active","category","stock_status"]
-    return [dict(zip(cols, r)) for r in rows]
-
-async def fetch_product_by_sku(sku: str):
-    async with aiosqlite.connect(DB_PATH) as d:
-        cur = await d.execute(
-            "SELECT sku,title,price,currency,image_url,description,is_active,category,stock_status FROM products WHERE sku=?",
-            (sku,)
-        )
-        r = await cur.fetchone()
-    if not r: return None
-    cols = ["sku","title","price","currency","image_url","description","is_active","category","stock_status"]
-    return dict(zip(cols, r))
-
-async def upsert_product(p: Dict[str, Any]):
-    async with aiosqlite.connect(DB_PATH) as d:
-        await d.execute("""
+    return [dict(r) for r in rows]
+
+# Все товары в памяти: sku -> строка. Корзина сверяется с ней без похода в SQLite.
+# upsert_product/delete_product правят карту сразу после коммита, а по CATALOG_TTL
+# она перечитывается целиком — как и витрина, чтобы правки базы в обход
+# приложения доходили и до цен при оформлении заказа.
+_products: Dict[str, Dict[str, Any]] = {}
+_products_ts = 0.0
+
+async def load_products():
+    global _products, _products_ts
+    version = _catalog_version
+    now = time.monotonic()
+    rows = await fetch_products(active_only=False)
+    # запись могла пройти, пока читали — её строка в карте новее прочитанной
+    if version == _catalog_version:
+        _products = {r["sku"]: r for r in rows}
+        _products_ts = now
+
+async def products_map() -> Dict[str, Dict[str, Any]]:
+    if time.monotonic() - _products_ts > CATALOG_TTL:
+        await load_products()
+    return _products
+
+# Кэш ответа /api/catalog: категория -> (etag, json bytes, gzip bytes, monotonic ts).
+# Версия растёт при каждой записи в products и сбрасывает кэш; TTL страхует
+# от правок базы в обход приложения. gzip считается один раз на сборку кэша,
+# а не на каждый ответ; для мелких ответов его нет (None).
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "60"))
+_catalog_version = 0
+_catalog_cache: Dict[str, Tuple[str, bytes, Optional[bytes], float]] = {}
+
+def invalidate_catalog():
+    global _catalog_version
+    _catalog_version += 1
+    _catalog_cache.clear()
+
+async def upsert_product(p: Dict[str, Any]) -> Dict[str, Any]:
+    async with write_tx() as d:
+        # RETURNING отдаёт итоговую строку тем же запросом, без повторного SELECT
+        cur = await d.execute("""
           INSERT INTO products (sku,title,price,currency,image_url,description,is_active,category,stock_status)
           VALUES (?,?,?,?,?,?,?,?,?)
           ON CONFLICT(sku) DO UPDATE SET
             title=excluded.title,
             price=excluded.price,
             currency=excluded.currency,
-            image_url=excluded.image_url,
-            description=excluded.description,
+            image_url=COALESCE(excluded.image_url, image_url),
+            description=COALESCE(excluded.description, description),
             is_active=excluded.is_active,
             category=excluded.category,
             stock_status=excluded.stock_status
+          RETURNING sku,title,price,currency,image_url,description,is_active,category,stock_status
         """, (
             p["sku"], p["title"], int(p["price"]), p.get("currency","UAH"),
             p.get("image_url"), p.get("description"),
@@ -128,16 +252,20 @@ async def upsert_product(p: Dict[str, Any]):
             p.get("category","devices"),
             p.get("stock_status","in_stock")
         ))
-        await d.commit()
+        row = dict(await cur.fetchone())
+    _products[row["sku"]] = row
+    invalidate_catalog()
+    return row
 
 async def delete_product(sku: str):
-    async with aiosqlite.connect(DB_PATH) as d:
+    async with write_tx() as d:
         await d.execute("DELETE FROM products WHERE sku=?", (sku,))
-        await d.commit()
+    _products.pop(sku, None)
+    invalidate_catalog()
 
 async def save_order(user, items: List[Tuple[str, str, int, int]], total: int, currency: str,
                      city: str, branch: str, receiver: str, phone: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as d:
+    async with write_tx() as d:
         cur = await d.execute(
             "INSERT INTO orders (tg_user_id,tg_username,tg_name,total,currency,city,branch,receiver,phone,status,created_at) "
             "VALUES (?,?,?,?,?,?,?,?,?,?,?)",
@@ -150,44 +278,110 @@ async def save_order(user, items: List[Tuple[str, str, int, int]], total: int, c
             )
         )
         order_id = cur.lastrowid
-        for sku, title, price, qty in items:
-            await d.execute(
-                "INSERT INTO order_items (order_id,product_sku,product_title,price,qty) VALUES (?,?,?,?,?)",
-                (order_id, sku, title, price, qty)
-            )
-        await d.commit()
+        await d.executemany(
+            "INSERT INTO order_items (order_id,product_sku,product_title,price,qty) VALUES (?,?,?,?,?)",
+            [(order_id, sku, title, price, qty) for sku, title, price, qty in items]
+        )
     return int(order_id)
 
+SQL_ORDERS = (
+    "SELECT id,tg_username,tg_name,total,currency,city,branch,receiver,phone,status,created_at "
+    "FROM orders ORDER BY id DESC LIMIT ?"
+)
+# позиции всех заказов страницы — одним запросом с постоянным текстом, а не IN (?,?,...)
+SQL_ORDER_ITEMS = (
+    "SELECT order_id,product_sku AS sku,product_title AS title,price,qty FROM order_items "
+    "WHERE order_id IN (SELECT id FROM orders ORDER BY id DESC LIMIT ?) ORDER BY id"
+)
+
 async def fetch_orders(limit: int = 50):
-    async with aiosqlite.connect(DB_PATH) as d:
-        cur = await d.execute(
-            "SELECT id,tg_username,tg_name,total,currency,city,branch,receiver,phone,status,created_at "
-            "FROM orders ORDER BY id DESC LIMIT ?", (limit,)
-        )
-        orders = await cur.fetchall()
-        out = []
-        for o in orders:
-            oid = o[0]
-            cur2 = await d.execute(
-                "SELECT product_sku,product_title,price,qty FROM order_items WHERE order_id=?",
-                (oid,)
-            )
-            items = await cur2.fetchall()
-            out.append({
-                "id": oid,
-                "tg_username": o[1],
-                "tg_name": o[2],
-                "total": o[3],
-                "currency": o[4],
-                "city": o[5],
-                "branch": o[6],
-                "receiver": o[7],
-                "phone": o[8],
-                "status": o[9],
-                "created_at": o[10],
-                "items": [{"sku":i[0],"title":i[1],"price":i[2],"qty":i[3]} for i in items]
-            })
-        return out
+    async with get_reader() as d:
+        # оба запроса в одном снимке WAL: заказ, пришедший между ними, не сдвинет окно LIMIT
+        await d.execute("BEGIN")
+        try:
+            orders = await (await d.execute(SQL_ORDERS, (limit,))).fetchall()
+            items = await (await d.execute(SQL_ORDER_ITEMS, (limit,))).fetchall()
+        finally:
+            await d.execute("COMMIT")
+    # имена колонок совпадают с ключами ответа — dict(row) без ручного маппинга
+    out = [{**dict(o), "items": []} for o in orders]
+    by_id = {o["id"]: o for o in out}
+    for i in items:
+        by_id[i["order_id"]]["items"].append({"sku": i["sku"], "title": i["title"], "price": i["price"], "qty": i["qty"]})
+    return out
+
+# -------------------- Schemas --------------------
+# Входные данные валидирует pydantic-core прямо из сырых байт JSON
+Text = Annotated[str, BeforeValidator(lambda v: "" if v is None else v), StringConstraints(strip_whitespace=True)]
+Required = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+
+def _truncate(v: Any) -> Any:
+    # как прежний int(): дробное число отбрасывает дробную часть, а не даёт ошибку.
+    # inf/nan — ValueError, его pydantic превращает в 422 (OverflowError ушёл бы в 500)
+    if isinstance(v, float):
+        if not math.isfinite(v):
+            raise ValueError("number must be finite")
+        return int(v)
+    return v
+
+Int = Annotated[int, BeforeValidator(_truncate)]
+
+class CartItemIn(BaseModel):
+    sku: Annotated[str, BeforeValidator(str)]
+    qty: Int = 1
+
+class CheckoutIn(BaseModel):
+    type: Optional[str] = None
+    items: List[CartItemIn] = []
+    city: Text = ""
+    branch: Text = ""
+    receiver: Text = ""
+    phone: Text = ""
+    tg_username: Text = ""
+
+class ProductIn(BaseModel):
+    # числовой sku/title из JSON, как и раньше, принимаем строкой
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+    sku: Required
+    title: Required
+    price: Annotated[Int, Field(gt=0)]
+    currency: str = "UAH"
+    image_url: Optional[str] = None
+    description: Optional[str] = None
+    is_active: bool = False
+    category: str = "devices"
+    stock_status: str = "in_stock"
+
+    @field_validator("is_active", mode="before")
+    @classmethod
+    def _is_active(cls, v: Any) -> bool:
+        return v in (True, 1, "1", "true", "on")
+
+def validation_error(e: ValidationError) -> web.HTTPException:
+    err = e.errors(include_url=False)[0]
+    if err["type"] == "json_invalid":
+        return web.HTTPBadRequest(text="bad json")
+    if not err["loc"]:
+        # тело — не объект (массив, число, строка)
+        return web.HTTPUnprocessableEntity(text=f"body: {err['msg']}")
+    loc = ".".join(str(x) for x in err["loc"])
+    return web.HTTPUnprocessableEntity(text=f"field '{loc}': {err['msg']}")
+
+async def build_cart(cart: List[CartItemIn]) -> Tuple[List[Tuple[str,str,int,int]], int, str]:
+    # Собираем позиции строго из каталога: цены и названия от клиента не принимаем
+    items: List[Tuple[str,str,int,int]] = []
+    total = 0
+    currency = "UAH"
+    products = await products_map()
+    for it in cart:
+        row = products.get(it.sku)
+        if not row or it.qty <= 0 or not row.get("is_active"):
+            continue
+        items.append((row["sku"], row["title"], int(row["price"]), it.qty))
+        total += int(row["price"]) * it.qty
+        currency = row.get("currency","UAH")
+    return items, total, currency
 
 # -------------------- Telegram Bot --------------------
 if not BOT_TOKEN:
@@ -196,30 +390,124 @@ if not BOT_TOKEN:
 bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp  = Dispatcher()
 
+# Уведомления админу копятся в очереди и уходят пачкой из фоновой задачи,
+# чтобы оформление заказа не ждало Telegram и всплеск заказов не бил по API.
+NOTIFY_BATCH_WINDOW = 0.5
+NOTIFY_SEPARATOR = "\n\n———\n\n"
+TG_TEXT_LIMIT = 4096
+NOTIFY_RETRIES = 3
+NOTIFY_STOP_TIMEOUT = 15.0
+# None в очереди — сигнал остановки воркеру
+_notify_q: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+
 async def notify_admin_text(text: str):
+    _notify_q.put_nowait(text)
+
+async def notify_worker():
+    # останавливается сам по None: досылает накопленное и выходит,
+    # а не отменяется посреди отправки
+    batch: List[str] = []
+    stop = False
+    while not stop:
+        msg = await _notify_q.get()
+        if msg is None:
+            stop = True
+        else:
+            batch.append(msg)
+            await asyncio.sleep(NOTIFY_BATCH_WINDOW)
+        while not _notify_q.empty():
+            msg = _notify_q.get_nowait()
+            if msg is None:
+                stop = True
+            else:
+                batch.append(msg)
+        await flush_notifications(batch)
+
+async def flush_notifications(batch: List[str]):
+    # отправленное сразу убираем из batch — повторно оно уже не уйдёт
+    while batch:
+        text, n = batch[0], 1
+        while n < len(batch) and len(text) + len(NOTIFY_SEPARATOR) + len(batch[n]) <= TG_TEXT_LIMIT:
+            text = f"{text}{NOTIFY_SEPARATOR}{batch[n]}"
+            n += 1
+        await send_admin_text_retry(text)
+        del batch[:n]
+
+async def start_notify_worker(app: web.Application):
+    app["notify_task"] = asyncio.create_task(notify_worker())
+
+async def stop_notify_worker(app: web.Application):
+    _notify_q.put_nowait(None)
+    try:
+        await asyncio.wait_for(app["notify_task"], NOTIFY_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Telegram не отвечает — wait_for уже отменил воркер, остаток теряем
+        print("Admin notify: worker stopped by timeout, pending messages dropped")
+
+# Второй бот создаётся один раз: его сессия держит соединение с Telegram между уведомлениями
+_admin_bot: Optional[Bot] = None
+
+async def close_bots(app: web.Application):
+    # после воркера уведомлений: его последняя пачка ещё идёт через эти сессии
+    global _admin_bot
+    if _admin_bot is not None:
+        await _admin_bot.session.close()
+        _admin_bot = None
+    await bot.session.close()
+
+async def send_admin_text(text: str) -> bool:
+    # True — доставлено (или слать некому), False — стоит повторить
+    global _admin_bot
     # try secondary bot first
     if ADMIN_BOT_TOKEN and ADMIN_CHAT_ID:
         try:
-            other = Bot(ADMIN_BOT_TOKEN)
-            await other.send_message(int(ADMIN_CHAT_ID), text)
-            await other.session.close()
-            return
+            if _admin_bot is None:
+                _admin_bot = Bot(ADMIN_BOT_TOKEN)
+            await _admin_bot.send_message(int(ADMIN_CHAT_ID), text)
+            return True
         except Exception:
             pass
     # fallback to main bot
     if ADMIN_ID:
         try:
             await bot.send_message(int(ADMIN_ID), text)
+            return True
         except Exception:
-            pass
+            return False
+    return not (ADMIN_BOT_TOKEN and ADMIN_CHAT_ID)
+
+async def send_admin_text_retry(text: str):
+    for attempt in range(NOTIFY_RETRIES):
+        if attempt:
+            await asyncio.sleep(2 ** (attempt - 1))
+        if await send_admin_text(text):
+            return
+    print("Admin notify failed:", text.splitlines()[0])
+
+def order_text(order_id: int, buyer: str, buyer_id: Any, items: List[Tuple[str,str,int,int]], total: int,
+               currency: str, city: str, branch: str, receiver: str, phone: str) -> str:
+    lines = "\n".join(f"• {t} × {q} = {p*q} {currency}" for _,t,p,q in items)
+    return (
+        f"🆕 Нове замовлення №{order_id}\n"
+        f"Покупець: {buyer}\n"
+        f"ID: {buyer_id}\n"
+        f"{lines}\nРазом: {total} {currency}\n"
+        f"Місто: {city}\nВідділення: {branch}\n"
+        f"Отримувач: {receiver} / {phone}"
+    )
+
+# Клавиатуры одинаковы для всех и зависят только от PUBLIC_BASE_URL — собираем один раз
+START_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🛍 Вітрина", web_app=WebAppInfo(url=f"{PUBLIC_BASE_URL}/index.html"))]
+])
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🛒 Адмінка", web_app=WebAppInfo(url=f"{PUBLIC_BASE_URL}/admin.html"))]
+])
 
 @dp.message(Command("start"))
 async def cmd_start(m: Message):
     # В /start — только витрина для всех
-    kb = [
-        [{"text": "🛍 Вітрина", "web_app": {"url": f"{request_base()}/index.html"}}]
-    ]
-    await m.answer("Привіт! Відкрий міні-магазин нижче 👇", reply_markup={"inline_keyboard": kb})
+    await m.answer("Привіт! Відкрий міні-магазин нижче 👇", reply_markup=START_KB)
 
 @dp.message(Command("admin"))
 async def cmd_admin(m: Message):
@@ -230,10 +518,7 @@ async def cmd_admin(m: Message):
         is_admin = False
     if not is_admin:
         return await m.answer("⛔️ Доступ заборонено.")
-    kb = [
-        [{"text": "🛒 Адмінка", "web_app": {"url": f"{request_base()}/admin.html"}}]
-    ]
-    await m.answer("Панель адміністратора:", reply_markup={"inline_keyboard": kb})
+    await m.answer("Панель адміністратора:", reply_markup=ADMIN_KB)
 
 @dp.message(Command("setadmin"))
 async def cmd_setadmin(m: Message):
@@ -246,34 +531,18 @@ async def cmd_setadmin(m: Message):
 async def on_webapp_data(m: Message):
     # данные из мини-аппа Telegram
     try:
-        data = json.loads(m.web_app_data.data)
-    except Exception:
+        data = CheckoutIn.model_validate_json(m.web_app_data.data)
+    except ValidationError:
         return await m.answer("Не вдалося прочитати дані з вітрини.")
-    if data.get("type") != "checkout":
+    if data.type != "checkout":
         return await m.answer("Невідомий тип даних від вітрини.")
 
-    items_in  = data.get("items", [])
-    items: List[Tuple[str,str,int,int]] = []
-    total = 0
-    currency = "UAH"
-
-    for it in items_in:
-        sku = str(it.get("sku"))
-        qty = int(it.get("qty", 1))
-        row = await fetch_product_by_sku(sku)
-        if not row or qty <= 0 or not row.get("is_active"):
-            continue
-        items.append((row["sku"], row["title"], int(row["price"]), qty))
-        total += int(row["price"]) * qty
-        currency = row.get("currency","UAH")
+    items, total, currency = await build_cart(data.items)
 
     if not items:
         return await m.answer("Кошик порожній.")
 
-    city     = (data.get("city") or "").strip()
-    branch   = (data.get("branch") or "").strip()
-    receiver = (data.get("receiver") or "").strip()
-    phone    = (data.get("phone") or "").strip()
+    city, branch, receiver, phone = data.city, data.branch, data.receiver, data.phone
 
     if not m.from_user.username:
         return await m.answer("Для оформлення замовлення потрібен нікнейм у Telegram (username). Додайте його в налаштуваннях Telegram.")
@@ -282,121 +551,145 @@ async def on_webapp_data(m: Message):
 
     await m.answer(f"✅ Замовлення №{order_id} успішно оформлено! Ми з вами зв’яжемося для підтвердження.")
 
-    lines = "\n".join([f"• {t} × {q} = {p*q} {currency}" for _,t,p,q in items])
-    txt = (
-        f"🆕 Нове замовлення №{order_id}\n"
-        f"Покупець: {m.from_user.first_name or ''} {m.from_user.last_name or ''} "
-        f"({('@'+m.from_user.username) if m.from_user.username else '—'})\n"
-        f"ID: {m.from_user.id}\n"
-        f"{lines}\nРазом: {total} {currency}\n"
-        f"Місто: {city}\nВідділення: {branch}\n"
-        f"Отримувач: {receiver} / {phone}"
-    )
-    await notify_admin_text(txt)
-
-# -------------------- HTTP helpers --------------------
-_request_base: str = ""
-def request_base() -> str:
-    return _request_base or os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+    u = m.from_user
+    buyer = f"{u.first_name or ''} {u.last_name or ''} ({('@'+u.username) if u.username else '—'})"
+    await notify_admin_text(order_text(order_id, buyer, u.id, items, total, currency, city, branch, receiver, phone))
 
 # -------------------- HTTP API --------------------
+# Мелкие ответы сжимать нет смысла — заголовки и CPU дороже выигрыша
+COMPRESS_MIN_SIZE = 1024
+
+def compressed(resp: web.Response) -> web.Response:
+    # gzip/deflate выбирается по Accept-Encoding клиента; без него — no-op.
+    # Vary — на обоих вариантах, иначе общий кэш отдаст gzip тому, кто его не просил
+    if resp.body is not None and len(resp.body) >= COMPRESS_MIN_SIZE:
+        resp.headers["Vary"] = "Accept-Encoding"
+        resp.enable_compression()
+    return resp
+
+def json_response(data: Any, status: int = 200) -> web.Response:
+    # orjson сразу отдаёт bytes — без json.dumps и повторного encode
+    return compressed(web.Response(body=orjson.dumps(data), status=status, content_type="application/json"))
+
+# сравниваем байты за постоянное время, чтобы секрет нельзя было подобрать по задержке
+_admin_secret_b = ADMIN_SECRET.encode()
+
 def require_admin(request: web.Request):
     secret = request.headers.get("X-Admin-Secret") or request.query.get("secret")
-    if not ADMIN_SECRET or secret != ADMIN_SECRET:
+    if not ADMIN_SECRET or not secret or not hmac.compare_digest(secret.encode(), _admin_secret_b):
         raise web.HTTPUnauthorized(text="Admin secret required")
 
 async def api_catalog(request: web.Request):
     category = request.query.get("category")
-    items = await fetch_products(active_only=True)
-    if category:
-        items = [i for i in items if (i.get("category") or "").lower() == category.lower()]
-    return web.json_response({"items": items})
+    key = (category or "").lower()
+    now = time.monotonic()
+    cached = _catalog_cache.get(key)
+    if cached is None or now - cached[3] > CATALOG_TTL:
+        version = _catalog_version
+        items = await fetch_products(active_only=True, category=category)
+        body = orjson.dumps({"items": items})
+        gz = gzip.compress(body, compresslevel=6) if len(body) >= COMPRESS_MIN_SIZE else None
+        cached = (f'"{version}-{hashlib.md5(body).hexdigest()[:16]}"', body, gz, now)
+        # запись могла пройти, пока читали — такой результат не кэшируем.
+        # Пустые категории тоже: ключ — произвольный ?category= от клиента,
+        # и кэш рос бы без предела; промах по индексу дешевле
+        if version == _catalog_version and (items or not key):
+            _catalog_cache[key] = cached
+    etag, body, gz, _ = cached
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+    headers = {"ETag": etag}
+    if gz is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("Accept-Encoding", "").lower():
+            headers["Content-Encoding"] = "gzip"
+            body = gz
+    return web.Response(body=body, content_type="application/json", headers=headers)
 
 async def api_orders(request: web.Request):
     require_admin(request)
     limit = int(request.query.get("limit","50"))
     data = await fetch_orders(limit=limit)
-    return web.json_response({"orders": data})
+    return json_response({"orders": data})
 
 async def api_product_upsert(request: web.Request):
     require_admin(request)
     try:
-        body = await request.json()
-    except Exception:
-        raise web.HTTPBadRequest(text="bad json")
-
-    required = ["sku","title","price"]
-    for k in required:
-        if not body.get(k):
-            raise web.HTTPBadRequest(text=f"field '{k}' required")
-
-    body.setdefault("currency","UAH")
-    body["is_active"] = 1 if body.get("is_active") in (True,1,"1","true","on") else 0
-    body.setdefault("category","devices")
-    body.setdefault("stock_status","in_stock")
-    await upsert_product(body)
-    return web.json_response({"ok": True})
+        body = ProductIn.model_validate_json(await request.read())
+    except ValidationError as e:
+        raise validation_error(e)
+    item = await upsert_product(body.model_dump())
+    return json_response({"ok": True, "item": item})
 
 async def api_product_delete(request: web.Request):
     require_admin(request)
     sku = request.match_info.get("sku","")
     await delete_product(sku)
-    return web.json_response({"ok": True})
+    return json_response({"ok": True})
+
+def _commit_upload(tmp: Path, path: Path):
+    # такой файл уже есть — дубликат не храним; иначе атомарно переименовываем
+    if path.exists():
+        tmp.unlink()
+    else:
+        os.replace(tmp, path)
 
 async def api_upload(request: web.Request):
     require_admin(request)
+    # заведомо большое тело отклоняем до чтения; без Content-Length спасает лимит в цикле
+    if request.content_length and request.content_length > MAX_UPLOAD_SIZE:
+        raise web.HTTPRequestEntityTooLarge(max_size=MAX_UPLOAD_SIZE, actual_size=request.content_length)
     reader = await request.multipart()
     field = await reader.next()
     if not field or field.name != "file":
         raise web.HTTPBadRequest(text="file field required")
 
     filename = field.filename or "upload.bin"
-    ext = (Path(filename).suffix or "").lower()
-    allow = {".jpg",".jpeg",".png",".webp"}
-    if ext not in allow:
+    dot = filename.rfind(".")
+    ext = filename[dot:].lower() if dot > 0 else ""
+    if ext not in UPLOAD_EXTS:
         raise web.HTTPUnsupportedMediaType(text="Allowed: jpg, jpeg, png, webp")
 
-    rnd = secrets.token_hex(8) + ext
-    path = Path(UPLOAD_DIR) / rnd
-    with path.open("wb") as f:
-        while True:
-            chunk = await field.read_chunk()
-            if not chunk: break
-            f.write(chunk)
-
-    url = f"/uploads/{rnd}"
-    return web.json_response({"url": url})
+    # имя файла — хэш содержимого: повторная загрузка того же файла даёт тот же URL
+    tmp = Path(UPLOAD_DIR) / (secrets.token_hex(8) + ".part")
+    # запись на диск — в пуле потоков, чтобы не блокировать event loop
+    loop = asyncio.get_running_loop()
+    digest = hashlib.blake2b(digest_size=16)
+    size = 0
+    try:
+        f = await loop.run_in_executor(None, tmp.open, "wb")
+        with f:
+            while True:
+                chunk = await field.read_chunk(UPLOAD_CHUNK)
+                if not chunk: break
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise web.HTTPRequestEntityTooLarge(max_size=MAX_UPLOAD_SIZE, actual_size=size)
+                digest.update(chunk)
+                await loop.run_in_executor(None, f.write, chunk)
+        name = digest.hexdigest() + ext
+        await loop.run_in_executor(None, _commit_upload, tmp, Path(UPLOAD_DIR) / name)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+    url = f"/uploads/{name}"
+    return json_response({"url": url})
 
 # === Public checkout (работает и вне Telegram) ===
 async def api_checkout(request: web.Request):
     try:
-        data = await request.json()
-    except Exception:
-        raise web.HTTPBadRequest(text="bad json")
+        data = CheckoutIn.model_validate_json(await request.read())
+    except ValidationError as e:
+        raise validation_error(e)
 
-    items_in = data.get("items", [])
-    city     = (data.get("city") or "").strip()
-    branch   = (data.get("branch") or "").strip()
-    receiver = (data.get("receiver") or "").strip()
-    phone    = (data.get("phone") or "").strip()
-    tg_user  = (data.get("tg_username") or "").strip().lstrip("@")
+    city, branch, receiver, phone = data.city, data.branch, data.receiver, data.phone
+    tg_user = data.tg_username.lstrip("@")
 
-    if not items_in:
+    if not data.items:
         raise web.HTTPBadRequest(text="empty cart")
 
-    # Собираем позиции строго из БД
-    items: List[Tuple[str,str,int,int]] = []
-    total = 0
-    currency = "UAH"
-    for it in items_in:
-        sku = str(it.get("sku"))
-        qty = int(it.get("qty", 1))
-        row = await fetch_product_by_sku(sku)
-        if not row or qty <= 0 or not row.get("is_active"):
-            continue
-        items.append((row["sku"], row["title"], int(row["price"]), qty))
-        total += int(row["price"]) * qty
-        currency = row.get("currency","UAH")
+    items, total, currency = await build_cart(data.items)
 
     if not items:
         raise web.HTTPBadRequest(text="no valid items")
@@ -410,33 +703,72 @@ async def api_checkout(request: web.Request):
 
     order_id = await save_order(u, items, total, currency, city, branch, receiver, phone)
 
-    lines = "\n".join([f"• {t} × {q} = {p*q} {currency}" for _,t,p,q in items])
     uname = f"@{tg_user}" if tg_user else "—"
-    txt = (
-        f"🆕 Нове замовлення №{order_id}\n"
-        f"Покупець: {receiver} ({uname})\n"
-        f"ID: 0 (браузер)\n"
-        f"{lines}\nРазом: {total} {currency}\n"
-        f"Місто: {city}\nВідділення: {branch}\n"
-        f"Отримувач: {receiver} / {phone}"
-    )
-    await notify_admin_text(txt)
+    await notify_admin_text(order_text(order_id, f"{receiver} ({uname})", "0 (браузер)",
+                                       items, total, currency, city, branch, receiver, phone))
 
-    return web.json_response({"ok": True, "order_id": order_id})
+    return json_response({"ok": True, "order_id": order_id})
 
 # -------------------- Static pages --------------------
+WEB_MAX_AGE = 60
+
+# HTML меняется только с деплоем: файлы читаются и сжимаются один раз в make_app(),
+# дальше отдаём из памяти — как тело каталога в api_catalog
+PAGES = ("index.html", "admin.html")
+_pages: Dict[str, Tuple[bytes, Optional[bytes], str]] = {}
+
+def load_pages():
+    for name in PAGES:
+        body = (WEB_DIR / name).read_bytes()
+        gz = gzip.compress(body, compresslevel=6) if len(body) >= COMPRESS_MIN_SIZE else None
+        _pages[name] = (body, gz, f'"{hashlib.md5(body).hexdigest()[:16]}"')
+
+def page_response(request: web.Request, name: str) -> web.Response:
+    body, gz, etag = _pages[name]
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers={"ETag": etag})
+    # после max-age браузер обязан сверить ETag, а не показывать устаревший шелл
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={WEB_MAX_AGE}, must-revalidate"}
+    if gz is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("Accept-Encoding", "").lower():
+            headers["Content-Encoding"] = "gzip"
+            body = gz
+    return web.Response(body=body, content_type="text/html", charset="utf-8", headers=headers)
+
 async def static_index(request: web.Request):
-    return web.FileResponse(WEB_DIR / "index.html")
+    return page_response(request, "index.html")
 
 async def static_admin(request: web.Request):
-    return web.FileResponse(WEB_DIR / "admin.html")
+    return page_response(request, "admin.html")
 
 async def health(request: web.Request):
-    return web.json_response({"ok": True})
+    return json_response({"ok": True})
+
+# Имя в /uploads/ — хэш содержимого, файл по нему не меняется, поэтому кэшируем навсегда.
+# В проде /uploads/ лучше отдавать nginx'ом напрямую (sendfile, без Python):
+#   location /uploads/ { alias /var/data/uploads/; sendfile on; tcp_nopush on;
+#                        add_header Cache-Control "public, max-age=31536000, immutable"; }
+async def cache_headers(request: web.Request, resp: web.StreamResponse):
+    # on_response_prepare, а не middleware: FileResponse узнаёт о 404 только в prepare(),
+    # а кэшировать можно лишь удачные ответы — 404 на год сломал бы URL и после загрузки файла
+    if resp.status not in (200, 304):
+        return
+    if request.path.startswith("/uploads/"):
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    elif request.path.startswith("/web/"):
+        # статика витрины меняется с деплоем: недолгий кэш, дальше ревалидация по ETag
+        resp.headers["Cache-Control"] = f"public, max-age={WEB_MAX_AGE}"
 
 # -------------------- Run everything --------------------
-async def start_bot_and_http():
+def make_app() -> web.Application:
     app = web.Application()
+    app.on_response_prepare.append(cache_headers)
+    load_pages()
+    app.on_startup.append(start_notify_worker)
+    app.on_cleanup.append(stop_notify_worker)
+    app.on_cleanup.append(close_bots)
+    app.on_cleanup.append(close_db)
     app.router.add_get("/health", health)
 
     app.router.add_get("/api/catalog", api_catalog)
@@ -452,31 +784,45 @@ async def start_bot_and_http():
 
     app.router.add_static("/uploads/", UPLOAD_DIR)
     app.router.add_static("/web/", str(WEB_DIR))
+    return app
 
-    runner = web.AppRunner(app)
+async def start_bot_and_http():
+    app = make_app()
+    # access log без настроенного logging никуда не пишется, но форматируется на каждый запрос
+    runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     print(f"HTTP on :{PORT}")
 
-    base = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
-    if base:
+    if PUBLIC_BASE_URL:
         try:
             await bot.set_chat_menu_button(
-                menu_button=MenuButtonWebApp(text="🛍 Вітрина", web_app=WebAppInfo(url=f"{base}/index.html"))
+                menu_button=MenuButtonWebApp(text="🛍 Вітрина", web_app=WebAppInfo(url=f"{PUBLIC_BASE_URL}/index.html"))
             )
-            print("Menu set to:", f"{base}/index.html")
+            print("Menu set to:", f"{PUBLIC_BASE_URL}/index.html")
         except Exception as e:
             print("Menu set error:", e)
 
-    await dp.start_polling(bot)
+    # start_polling сам ловит SIGINT/SIGTERM и возвращается — после этого гасим HTTP и БД
+    try:
+        # сессию бота закрывает close_bots — после того, как воркер дошлёт уведомления
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await runner.cleanup()
 
 async def main():
     await init_db()
     await start_bot_and_http()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop (Linux) заметно быстрее стандартного цикла; без него — обычный asyncio
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
 
 
 